@@ -16,10 +16,23 @@ line.
 
 """
 
-import argparse, textwrap, logging, os, inspect, traceback, random, string, sys, re
+import argparse, textwrap, logging, os, traceback, random, string, struct, sys, re
 from itertools import chain
-from collections import namedtuple, OrderedDict
-import xml.etree.ElementTree as ET
+from functools import lru_cache
+from collections import defaultdict
+try:
+    from lxml import etree as ET
+    ParseError = ET.XMLSyntaxError
+    # lxml keeps comments as elements by default, which the stdlib parser drops.
+    # Descriptor ids are resolved by the collection, so libxml2 needn't index them.
+    PARSER_OPTIONS = { 'remove_comments': True, 'collect_ids': False }
+    # lxml parsers accept a new document once the previous one is closed
+    REUSABLE_PARSER = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    ParseError = ET.ParseError
+    PARSER_OPTIONS = {}
+    REUSABLE_PARSER = False
 
 ###############################################################################
 # Descriptor items
@@ -29,9 +42,9 @@ import xml.etree.ElementTree as ET
 # the parent TagHandler.
 #
 # The top-level TagHandler is the Descriptor. Most other tag handlers are
-# direct descendents of this handler. It contains a "to_source" method which
-# will parse its children and call their "to_source" methods in order to
-# generate a single string of C source code.
+# direct descendents of this handler. Its "emit" method calls "emit" on each
+# of its children, which append their lines of C source code to a single
+# shared list.
 #
 # The other tag handlers generate content in various ways, some by just
 # formatting the text of the element in a certain way, others by referencing
@@ -45,39 +58,46 @@ import xml.etree.ElementTree as ET
 #     defined on the base TagHandler and is recursive. The purpose of this
 #     method is to allow TagHandlers the chance to generate properties based
 #     on other descriptors.
-#  3. Source is generated by calling "to_source" on each top level descriptor.
+#  3. Source is generated by DescriptorCollection.to_source, which has each
+#     top level descriptor "emit" into one shared list of lines and joins
+#     that list once. Lengths and computed content are only read during this
+#     step, once every descriptor has been post-parsed, so handlers may
+#     compute them on first use and keep them.
 ###############################################################################
 
-DescriptorTag = namedtuple('DescriptorTag', ['tag'])
-NestedType = namedtuple('NestedType', ['type'])
+# Maps each tag name to the TagHandler class which parses it
+_TAG_REGISTRY = {}
 
 def handles_tag(tag):
     """
     Attaches a tag to a class for parsing purposes
     """
+    # Element tags are looked up in the registry for every element parsed
+    tag = sys.intern(tag)
     def decorator(cls):
-        if not inspect.isclass(cls):
+        if not isinstance(cls, type):
             raise ValueError("The @handles_tag decorator is only valid for classes")
-        attrname_format = '__tagname{}'
-        index = 0
-        while hasattr(cls, attrname_format.format(index)):
-            index += 1
-        setattr(cls, attrname_format.format(index), DescriptorTag(tag))
+        if tag in _TAG_REGISTRY:
+            raise ValueError("Tag {} is already handled by {}".format(tag, _TAG_REGISTRY[tag].__name__))
+        cls._handled_tags = getattr(cls, '_handled_tags', frozenset()) | {tag}
+        _TAG_REGISTRY[tag] = cls
         return cls
     return decorator
 
 def child_of(tag_cls):
     """
     Declares that this is a child of the passed tag handler class
+
+    This must be applied above the @handles_tag decorator(s) of the class
     """
     def decorator(cls):
-        if not inspect.isclass(cls):
+        if not isinstance(cls, type):
             raise ValueError("The @child_of decorator is only valid for classes")
-        attrname_format = '__child_tag{}'
-        index = 0
-        while hasattr(tag_cls, attrname_format.format(index)):
-            index += 1
-        setattr(tag_cls, attrname_format.format(index), NestedType(cls))
+        if not getattr(cls, '_handled_tags', None):
+            raise ValueError("The @child_of decorator must be applied after @handles_tag")
+        handlers = dict(getattr(tag_cls, '_child_handlers', {}))
+        handlers.update((t, cls) for t in cls._handled_tags)
+        tag_cls._child_handlers = handlers
         return cls
     return decorator
 
@@ -85,64 +105,82 @@ def attrib_bool(el, attr_name):
     """
     Determines if the boolean attribute is set or cleared
     """
-    return attr_name in el.attrib and el.attrib[attr_name] == attr_name
+    return el.get(attr_name) == attr_name
+
+@lru_cache(maxsize=256)
+def parse_int(text):
+    """
+    Parses an integer attribute value. The same few values (descriptor types,
+    sizes) appear over and over, so the results are cached.
+    """
+    return int(text, 0)
+
+def attrib_int(el, attr_name, default=None):
+    """
+    Reads an optional integer attribute
+    """
+    value = el.get(attr_name)
+    return parse_int(value) if value is not None else default
+
+def indent_lines(out, start):
+    """
+    Indents every line appended to out since the passed start index
+    """
+    out[start:] = ['  ' + line for line in out[start:]]
+
+# C literal for every possible byte value
+HEX_BYTES = ['0x{:02X}'.format(b) for b in range(256)]
+
+# Low byte of a UTF-16 code unit: a character literal where one is safe to
+# write verbatim, otherwise the hex literal
+CHAR_BYTES = ["'{}'".format(chr(b)) if 0x20 <= b < 0x7F and chr(b) not in "'\\" else HEX_BYTES[b]
+        for b in range(256)]
+
+INT_LITERAL_RE = re.compile(r'^\s*(0[xX][0-9a-fA-F]+|[1-9][0-9]*|0)\s*$')
+
+def literal_int(text):
+    """
+    Returns the value of the passed text if it is a plain decimal or hex
+    integer literal. Returns None for anything else (macros, expressions).
+    """
+    if text is None or not INT_LITERAL_RE.match(text):
+        return None
+    return int(text, 0)
 
 class TagHandler(object):
     """
     Base object which handles a tag and nested tags
     """
+    __slots__ = ('id', 'children')
     logger = logging.getLogger('TagHandler')
+    # Whether instances have a length in bytes and generate header lines
+    HAS_LEN = False
+    HAS_HEADER = False
+    # Populated by the @handles_tag and @child_of decorators
+    _handled_tags = frozenset()
+    _child_handlers = {}
+
     def parse(el, parent=None):
-        TagHandler.logger.info("visiting {}".format(el))
-        handled = False
-        for c in TagHandler.subclasses():
-            if c.match_tag(el):
-                handled = True
-                yield c(el, parent)
-        if not handled:
-            TagHandler.logger.warn('Element {} was not handled'.format(el))
-
-    @classmethod
-    def subclasses(cls):
-        all_cls = []
-        for c in cls.__subclasses__():
-            all_cls.append(c)
-            all_cls.extend(c.subclasses())
-        return all_cls
-
-    @classmethod
-    def match_tag(cls, el):
-        """
-        Returns whether or not this handler can handle the passed tag
-        """
-        for attr_name in dir(cls):
-            attr = getattr(cls, attr_name)
-            if isinstance(attr, DescriptorTag) and attr.tag == el.tag:
-                return True
-        return False
-
-    @classmethod
-    def match_child(cls, el):
-        """
-        Returns whether or not the passed element is a valid child of the
-        passed tag handler
-        """
-        for attr_name in dir(cls):
-            attr = getattr(cls, attr_name)
-            if isinstance(attr, NestedType) and attr.type.match_tag(el):
-                return True
-        return False
+        TagHandler.logger.info("visiting %s", el)
+        c = _TAG_REGISTRY.get(el.tag)
+        if c is None:
+            TagHandler.logger.warning("Element %s was not handled", el)
+            return
+        yield c(el, parent)
+
     def __init__(self, el, parent=None):
-        if not type(self).match_tag(el):
+        if el.tag not in self._handled_tags:
             raise ValueError('Type {} cannot handle {}'.format(type(self), el))
         # all tags may have an ID
-        self.id = el.attrib['id'] if 'id' in el.attrib else None
+        self.id = el.get('id')
         self.children = []
+        child_handlers = self._child_handlers
         for e in el:
-            if self.match_child(e):
-                self.children.extend(TagHandler.parse(e, self))
-            else:
+            c = child_handlers.get(e.tag)
+            if c is None:
                 raise ValueError('{}: Unexpected child {}'.format(el, e))
+            TagHandler.logger.info("visiting %s", e)
+            self.children.append(c(e, self))
 
     def post_parse(self, descriptor_collection):
         """
@@ -151,20 +189,28 @@ class TagHandler(object):
         for c in self.children:
             c.post_parse(descriptor_collection)
 
+    def emit(self, out):
+        """
+        Appends the lines of source generated by this handler to out, one
+        line per item. By default a handler generates no source.
+        """
+        pass
+
 @handles_tag('include')
 class IncludeHandler(TagHandler):
     """
     Includes a file whose name appears in the text of this item. The file is
     only included in the source
     """
+    __slots__ = ('filename',)
     def __init__(self, el, parent=None):
         if parent is not None:
             raise ValueError('An include may not be the child of any element')
         if not el.text:
             raise ValueError('An include requires text')
         self.filename = el.text
-    def to_source(self):
-        return '#include "{}"'.format(self.filename)
+    def emit(self, out):
+        out.append('#include "{}"'.format(self.filename))
 
 
 @handles_tag('descriptor')
@@ -173,24 +219,26 @@ class Descriptor(TagHandler):
     Descriptor class. This represents the bare minimum required of a USB
     descriptor. By itself, no content is created.
     """
+    __slots__ = ('type', 'top', 'first', 'parentid', 'order', 'wIndex', 'wIndexType', '_index')
     def __init__(self, el, parent=None):
         if parent is not None:
             raise ValueError('A descriptor may not be the child of any element')
-        self.type = int(el.attrib['type'], 0)
-        self.top = ('childof' not in el.attrib) or attrib_bool(el, 'top')
+        attrib = el.attrib
+        self.type = parse_int(attrib['type'])
+        self.parentid = attrib.get('childof')
+        self.top = self.parentid is None or attrib_bool(el, 'top')
         self.first = attrib_bool(el, 'first')
-        self.parentid = el.attrib['childof'] if 'childof' in el.attrib else None
-        self.order = int(el.attrib['order'], 0) if 'order' in el.attrib else 0 # Highest numbers outputted first
+        self.order = attrib_int(el, 'order', 0) # Highest numbers outputted first
         # A word about wIndex: wIndex is used in the descriptor table for
         # matching a particular descriptor to a setup request. For strings, the
         # index is the language id. For descriptors like HID, it is the
         # interface index. For descriptors like a configuration, it is its own
         # index (we don't cover this case yet).
-        self.wIndex = int(el.attrib['wIndex'], 0) if 'wIndex' in el.attrib else None # Direct declaration of the wIndex
-        self.wIndexType = int(el.attrib['wIndexType'], 0) if 'wIndexType' in el.attrib else None # The wIndexType is a descriptor type
-        if 'wIndex' in el.attrib and 'wIndexType' in el.attrib:
+        self.wIndex = attrib_int(el, 'wIndex') # Direct declaration of the wIndex
+        self.wIndexType = attrib_int(el, 'wIndexType') # The wIndexType is a descriptor type
+        if self.wIndex is not None and self.wIndexType is not None:
             raise ValueError("A descriptor may not declare both a wIndex and wIndexType")
-        if 'wIndexType' in el.attrib and 'childof' not in el.attrib:
+        if self.wIndexType is not None and self.parentid is None:
             raise ValueError("A wIndexType in a descriptor requires that the descriptor have a childof attribute")
         super().__init__(el, parent)
     @property
@@ -214,9 +262,10 @@ class Descriptor(TagHandler):
         elif self.wIndex is None:
             self.wIndex = 0
     def to_header(self):
-        return os.linesep.join([c.to_header() for c in self.children if hasattr(c, 'to_header')])
-    def to_source(self):
-        return os.linesep.join([c.to_source() for c in self.children if hasattr(c, 'to_source')])
+        return '\n'.join([c.to_header() for c in self.children if c.HAS_HEADER])
+    def emit(self, out):
+        for c in self.children:
+            c.emit(out)
     def __repr__(self):
         return '<{}: Id: {}, Type: {}>'.format(type(self), self.id, self.type)
 
@@ -225,6 +274,8 @@ class BinaryContent(TagHandler):
     Base binary content, generally not useful since by default it outputs
     nothing other than a comment which contins a name
     """
+    __slots__ = ('name',)
+    HAS_LEN = True
     def __init__(self, el, parent=None):
         self.name = el.attrib['name']
         super().__init__(el, parent)
@@ -242,30 +293,65 @@ class BinaryContent(TagHandler):
         to correspond to the length of the sequence in __iter__
         """
         raise NotImplementedError
-    def to_source(self):
-        source = list(['{},'.format(b) for b in self])
-        if len(source):
-            source[0] += ' //' + self.name
-        return os.linesep.join(source)
+    def emit(self, out):
+        start = len(out)
+        out.extend(['{},'.format(b) for b in self])
+        if len(out) > start:
+            out[start] += ' //' + self.name
 
 class SizedContent(BinaryContent):
     """
     Binary content which has an explicit size between 1 and 4 bytes
 
     This can have a content function which is invoked when the item is
-    iterated, or it can take its content from the text of the element
-    """
-    def __init__(self, el, parent=None, size=None, contentfn=None):
-        self.size = int(el.attrib['size'], 0) if size is None else size
-        self.contentfn = contentfn if contentfn else lambda: el.text
+    iterated, be passed content which is already known, or take its content
+    from the text of the element. Content which becomes fixed during
+    post-parse can be set with set_content.
+    """
+    __slots__ = ('size', 'contentfn', '__template', '__source')
+    def __init__(self, el, parent=None, size=None, contentfn=None, content=None):
+        self.size = parse_int(el.attrib['size']) if size is None else size
+        self.__template = ', '.join(['((({{0}}) >> {}) & 0xFF)'.format(i*8) for i in range(0, self.size)])
+        self.__source = None
+        self.contentfn = contentfn
+        if contentfn is None:
+            if content is None:
+                # The element is cleared after parsing, so keep only its text.
+                # Plain integers are emitted as literal bytes.
+                text = el.text
+                value = literal_int(text)
+                content = text if value is None else value
+            self.set_content(content)
         super().__init__(el, parent)
     def __len__(self):
         return self.size
+    def unresolved(self):
+        """
+        Content function for items whose content is only set during post-parse
+        """
+        raise ValueError('{} has no content before post-parse'.format(type(self).__name__))
+    def set_content(self, content):
+        """
+        Fixes the content of this item and renders it once
+        """
+        self.contentfn = lambda: content
+        self.__source = self.render(content)
+    def render(self, content):
+        """
+        Renders the passed content as a comma-separated list of its bytes
+        """
+        if isinstance(content, int):
+            data = (content & ((1 << (self.size*8)) - 1)).to_bytes(self.size, 'little')
+            return ', '.join([HEX_BYTES[b] for b in data])
+        return self.__template.format(content)
     def __iter__(self):
-        content = self.contentfn()
-        parts = list(['((({}) >> {}) & 0xFF)'.format(content, i*8) for i in range(0, self.size)])
-        if len(parts):
-            yield ', '.join(parts)
+        if not self.size:
+            return
+        if self.__source is None:
+            # Computed content is fixed once every descriptor has been
+            # post-parsed, so it only needs rendering once
+            self.__source = self.render(self.contentfn())
+        yield self.__source
 
 @child_of(Descriptor)
 @handles_tag('property')
@@ -274,18 +360,21 @@ class PropertyContent(SizedContent):
     Sized content which has a name and content, but only generates source and a
     size under certain conditions
     """
+    __slots__ = ()
     def __init__(self, el, parent=None):
         if not el.text:
             raise ValueError('PropertyContent expects a non-empty element text')
         super().__init__(el, parent)
     def __len__(self):
         return 0
-    def to_source(self):
-        return ''
+    def emit(self, out):
+        pass
     def property_len(self):
         return super().__len__()
     def property_source(self):
-        return super().to_source()
+        out = []
+        super().emit(out)
+        return '\n'.join(out)
 
 @child_of(Descriptor)
 @handles_tag('hidden')
@@ -293,12 +382,13 @@ class HiddenContent(SizedContent):
     """
     Sized content which has a name and content, but does not generate any source
     """
+    __slots__ = ()
     def __init__(self, el, parent=None):
         if not el.text:
             raise ValueError('HiddenContent expects a non-empty element text')
         super().__init__(el, parent)
-    def to_source(self):
-        return ''
+    def emit(self, out):
+        pass
 
 @child_of(Descriptor)
 @handles_tag('byte')
@@ -306,6 +396,7 @@ class ByteContent(SizedContent):
     """
     Binary content for a single constant byte
     """
+    __slots__ = ()
     def __init__(self, el, parent=None):
         if not el.text:
             raise ValueError('ByteContent expects a non-empty element text')
@@ -317,6 +408,7 @@ class WordContent(SizedContent):
     """
     Binary content for a two constant bytes
     """
+    __slots__ = ('content',)
     def __init__(self, el, parent=None):
         if not el.text:
             raise ValueError('WordContent expects a non-empty element text')
@@ -329,15 +421,24 @@ class StringContent(BinaryContent):
     """
     String constant content
     """
+    __slots__ = ('bytes', '__words', '__lines')
     def __init__(self, el, parent=None):
         if not el.text:
             raise ValueError('StringContent expects a non-empty element text')
         self.bytes = el.text.encode('utf_16_le')
+        # The text never changes, so format each UTF-16 code unit up front
+        self.__words = ['{}, {}'.format(CHAR_BYTES[lo] if hi == 0 else HEX_BYTES[lo], HEX_BYTES[hi])
+                for lo, hi in struct.iter_unpack('<2B', self.bytes)]
         super().__init__(el, parent)
+        # The source lines only depend on the text and name, so they are kept
+        # ready to be emitted as well
+        out = []
+        super().emit(out)
+        self.__lines = out
     def __iter__(self):
-        for word in ['{}, 0x{:02X}'.format("'{}'".format(chr(self.bytes[i])) if self.bytes[i+1] == 0 else hex(self, bytes[i]), self.bytes[i+1])
-                for i in range(0, len(self.bytes), 2)]:
-            yield word
+        return iter(self.__words)
+    def emit(self, out):
+        out.extend(self.__lines)
     def __len__(self):
         return len(self.bytes)
 
@@ -347,6 +448,7 @@ class DescriptorLength(SizedContent):
     """
     Generates content containing the length of the parent descriptor
     """
+    __slots__ = ('all', 'parent')
     def __init__(self, el, parent):
         #TODO: Make this require a parent and count the length of the parent plus all descriptors which claim it as a parent
         # (this is the "all" attribute)
@@ -354,9 +456,8 @@ class DescriptorLength(SizedContent):
         self.parent = parent
         super().__init__(el, parent, contentfn=self.parent_length)
     def parent_length(self):
-        length = sum([len(c) for c in self.parent.children
-            if hasattr(c, '__len__') and (self.all or not isinstance(c, ChildrenContent))])
-        return length
+        return sum(len(c) for c in self.parent.children
+            if c.HAS_LEN and (self.all or not isinstance(c, ChildrenContent)))
 
 @child_of(Descriptor)
 @handles_tag('type')
@@ -364,11 +465,11 @@ class DescriptorType(SizedContent):
     """
     Generates content containing the type of the parent descriptor
     """
+    __slots__ = ('parent',)
     def __init__(self, el, parent):
         self.parent = parent
-        super().__init__(el, parent, contentfn=self.parent_type)
-    def parent_type(self):
-        return self.parent.type
+        # The parent's type is read before its children are parsed
+        super().__init__(el, parent, content=parent.type)
 
 @child_of(Descriptor)
 @handles_tag('ref')
@@ -376,16 +477,15 @@ class DescriptorRef(SizedContent):
     """
     Generates content containing the index of another descriptor
     """
+    __slots__ = ('type', 'refid')
     def __init__(self, el, parent=None):
-        self.type = int(el.attrib['type'], 0)
+        self.type = parse_int(el.attrib['type'])
         #TODO: Get rid of type, there's no need
         self.refid = el.attrib['refid']
-        super().__init__(el, parent, contentfn=self.index)
-    def index(self):
-        return self.__index
+        super().__init__(el, parent, contentfn=self.unresolved)
     def post_parse(self, descriptor_collection):
         super().post_parse(descriptor_collection)
-        self.__index = descriptor_collection.find_by_id(self.refid).index
+        self.set_content(descriptor_collection.find_by_id(self.refid).index)
 
 @child_of(Descriptor)
 @handles_tag('index')
@@ -393,14 +493,13 @@ class DescriptorIndex(SizedContent):
     """
     Generates content containing the parent descriptor's index
     """
+    __slots__ = ('parent',)
     def __init__(self, el, parent):
         self.parent = parent
-        super().__init__(el, parent, contentfn=self.index)
-    def index(self):
-        return self.__index
+        super().__init__(el, parent, contentfn=self.unresolved)
     def post_parse(self, descriptor_collection):
         super().post_parse(descriptor_collection)
-        self.__index = self.parent.index
+        self.set_content(self.parent.index)
 
 @child_of(Descriptor)
 @handles_tag('count')
@@ -408,18 +507,17 @@ class DescriptorCount(SizedContent):
     """
     Generates content containing the total number of some type of descriptor.
     """
+    __slots__ = ('parent', 'associated', 'type')
     def __init__(self, el, parent=None):
         self.parent = parent
         self.associated = attrib_bool(el, 'associated')
-        self.type = int(el.attrib['type'], 0)
-        super().__init__(el, parent, contentfn=self.count)
-    def count(self):
-        return self.__count
+        self.type = parse_int(el.attrib['type'])
+        super().__init__(el, parent, contentfn=self.unresolved)
     def post_parse(self, descriptor_collection):
         super().post_parse(descriptor_collection)
         descriptors = [d for d in descriptor_collection.find_by_type(self.type)
                 if not self.associated or self.parent is None or d.parentid == self.parent.id]
-        self.__count = len(descriptors)
+        self.set_content(len(descriptors))
 
 @child_of(Descriptor)
 @handles_tag('foreach')
@@ -427,21 +525,27 @@ class ForeachDescriptor(TagHandler):
     """
     Iterates descriptors of a particular type and generates content from them
     """
+    __slots__ = ('parent', 'associated', 'unique', 'type', 'child_descriptors', '__length')
+    HAS_LEN = True
     def __init__(self, el, parent):
         self.parent = parent
         self.associated = attrib_bool(el, 'associated')
         self.unique = attrib_bool(el, 'unique')
-        self.type = int(el.attrib['type'], 0)
+        self.type = parse_int(el.attrib['type'])
+        self.__length = None
         super().__init__(el, parent)
     def post_parse(self, descriptor_collection):
-        super().post_parse(descriptor_collection)
+        # The echoed descriptors must be known before the echoes post-parse
         self.child_descriptors = [d for d in descriptor_collection.find_by_type(self.type)\
                 if self.parent != d and (not self.associated or d.parentid == self.parent.id)]
-        self.sources = list([(len(c), list(c)) for c in self.children])
+        super().post_parse(descriptor_collection)
     def __len__(self):
-        return sum([len(c) for c in self.children if hasattr(c, '__len__')])
-    def to_source(self):
-        return os.linesep.join([line for c in self.children for line in c])
+        if self.__length is None:
+            self.__length = sum(len(c) for c in self.children)
+        return self.__length
+    def emit(self, out):
+        for c in self.children:
+            out.extend(c)
 
 
 @child_of(ForeachDescriptor)
@@ -450,16 +554,20 @@ class EchoContent(BinaryContent):
     """
     Echoes binary content of a particular name from a descriptor
     """
+    __slots__ = ('parent', 'targets', '__length')
     def __init__(self, el, parent):
         self.parent = parent
+        self.__length = None
         super().__init__(el, parent)
-    def __to_echo(self):
-        descriptors = [c for d in self.parent.child_descriptors\
+    def post_parse(self, descriptor_collection):
+        super().post_parse(descriptor_collection)
+        self.targets = [c for d in self.parent.child_descriptors\
                 for c in d.children if isinstance(c, BinaryContent) and c.name == self.name]
+    def __to_echo(self):
         data = [
-            (d.property_len() if hasattr(d, 'property_len') else len(d),
-                ','.join(d)) for d in descriptors]
-        if hasattr(self.parent, 'unique') and self.parent.unique:
+            (d.property_len() if isinstance(d, PropertyContent) else len(d),
+                ','.join(d)) for d in self.targets]
+        if self.parent.unique:
             data = set(data)
         else:
             data = list(data)
@@ -468,8 +576,9 @@ class EchoContent(BinaryContent):
         for l, c in self.__to_echo():
             yield c + ','
     def __len__(self):
-        lens = [e[0] for e in self.__to_echo()]
-        return sum(lens)
+        if self.__length is None:
+            self.__length = sum(e[0] for e in self.__to_echo())
+        return self.__length
 
 @child_of(Descriptor)
 @handles_tag('children')
@@ -478,35 +587,43 @@ class ChildrenContent(TagHandler):
     Iterates descriptors which claim our parent as theirs and generates
     content from them
     """
+    __slots__ = ('parent', 'type', 'child_descriptors', '__length')
+    HAS_LEN = True
+    HAS_HEADER = True
     def __init__(self, el, parent):
         self.parent = parent
-        self.type = int(el.attrib['type'], 0)
+        self.type = parse_int(el.attrib['type'])
+        self.__length = None
         super().__init__(el, parent)
     def post_parse(self, descriptor_collection):
         super().post_parse(descriptor_collection)
         all_of_type = descriptor_collection.find_by_type(self.type)
         self.child_descriptors = [d for d in all_of_type if d.parentid == self.parent.id]
     def __len__(self):
-        return sum([len(c) for d in self.child_descriptors for c in d.children if hasattr(c, '__len__')])
-    def __iter__(self):
-        for d in self.child_descriptors:
-            yield '/** Descriptor "{}" (type: {}) begin **/'.format(d.id, d.type)
-            # Indent the child content slightly
-            yield '  ' + d.to_source().replace('\n', '\n  ')
-            yield '/** Descriptor "{}" (type: {}) end **/'.format(d.id, d.type)
+        if self.__length is None:
+            self.__length = sum(len(c) for d in self.child_descriptors for c in d.children if c.HAS_LEN)
+        return self.__length
     def headers(self):
         for d in self.child_descriptors:
             yield d.to_header()
     def to_header(self):
-        return os.linesep.join(self.headers())
-    def to_source(self):
-        return os.linesep.join(self)
+        return '\n'.join(self.headers())
+    def emit(self, out):
+        for d in self.child_descriptors:
+            out.append('/** Descriptor "{}" (type: {}) begin **/'.format(d.id, d.type))
+            # Indent the child content slightly
+            start = len(out)
+            d.emit(out)
+            indent_lines(out, start)
+            out.append('/** Descriptor "{}" (type: {}) end **/'.format(d.id, d.type))
 
 
 class Endpoint(SizedContent):
     """
     Generates an endpoint address
     """
+    __slots__ = ('dir_in', 'define', '__endpoint')
+    HAS_HEADER = True
     def __init__(self, el, parent=None, dir_in=False):
         self.dir_in = dir_in
         self.define = el.attrib['define']
@@ -527,6 +644,7 @@ class InEndpoint(Endpoint):
     """
     Generates the endpoint address for an IN endpoint
     """
+    __slots__ = ()
     def __init__(self, el, parent=None):
         super().__init__(el, parent, True)
 
@@ -536,6 +654,7 @@ class OutEndpoint(Endpoint):
     """
     Generates an endpoint address for an OUT endpoint
     """
+    __slots__ = ()
     def __init__(self, el, parent=None):
         super().__init__(el, parent, False)
 
@@ -545,16 +664,61 @@ class RawContent(TagHandler):
     """
     Generates raw text content
     """
+    __slots__ = ('raw',)
     def __init__(self, el, parent=None):
         self.raw = el.text
         super().__init__(el, parent)
-    def to_source(self):
-        return self.raw
+    def emit(self, out):
+        out.extend(self.raw.split('\n'))
 
 ###############################################################################
 # Formatting and organization
 ###############################################################################
 
+# Templates for the generated files, filled in with str.format
+
+SOURCE_BANNER = """
+/******************************************************************************
+ * AUTOGENERATED FILE
+ *
+ * DO NOT MODIFY!
+ *
+ * Invocation:
+ * {invocation}
+ *****************************************************************************/
+ """
+
+HEADER_PROLOGUE = """#ifndef _USB_DESCRIPTOR_AUTOGEN_H_
+#define _USB_DESCRIPTOR_AUTOGEN_H_
+
+/******************************************************************************
+ * AUTOGENERATED FILE
+ *
+ * DO NOT MODIFY!
+ *
+ * Invocation:
+ * {invocation}
+ *****************************************************************************/
+
+#include <stdint.h>
+#include <stddef.h>
+
+typedef struct {{
+    uint16_t wValue;
+    uint16_t wIndex;
+    size_t length;
+    const void *addr;
+}} USBDescriptorEntry;
+
+extern const USBDescriptorEntry usb_descriptors[];"""
+
+DESCRIPTOR_BEGIN = 'static const USB_DATA_ALIGN uint8_t {id}[] = {{'
+DESCRIPTOR_END = '};\n'
+DESCRIPTOR_TABLE_BEGIN = 'const USBDescriptorEntry usb_descriptors[] = {'
+DESCRIPTOR_TABLE_ENTRY = '  {{ 0x{d.type:02x}{d.index:02x}, {d.wIndex:#06x}, sizeof({d.id}), {d.id} }},'
+DESCRIPTOR_TABLE_END = """  { 0x0000, 0x0000, 0x00, NULL }
+};"""
+
 class DescriptorCollectionBuilder(object):
     """
     Collates descriptors from elements in preparation for compiling them
@@ -569,7 +733,7 @@ class DescriptorCollectionBuilder(object):
     - All "id" attributes must be unique
     """
     def __init__(self):
-        self.descriptors = {}
+        self.descriptors = defaultdict(list)
         self.includes = []
     def add_descriptors(self, el):
         """
@@ -578,15 +742,13 @@ class DescriptorCollectionBuilder(object):
         for d in TagHandler.parse(el):
             if isinstance(d, IncludeHandler):
                 self.includes.append(d)
-            elif d.type not in self.descriptors:
-                self.descriptors[d.type] = [d]
             else:
                 self.descriptors[d.type].append(d)
 
     def __iter__(self):
-        for n, arry in self.descriptors.items():
-            for d in arry:
-                yield n, d
+        # Descriptors stay grouped by type, which sets the order in which
+        # endpoints are reserved
+        return ((d.type, d) for d in chain.from_iterable(self.descriptors.values()))
 
     def compile(self):
         """
@@ -604,43 +766,36 @@ class DescriptorCollection(object):
     def __init__(self, builder, max_endpoints=8):
         self.__endpoint = 1
         self.max_endpoints = max_endpoints
-        self.top = {}
+        self.top = defaultdict(list)
         self.by_id = {}
-        self.by_type = {}
-        self.indexes = {}
+        self.by_type = defaultdict(list)
+        self.indexes = defaultdict(int)
         self.includes = builder.includes
         for typenum, desc in builder:
             # Handle top-level descriptors
             if desc.top:
-                if typenum not in self.top:
-                    self.top[typenum] = [desc]
-                else:
-                    self.top[typenum].append(desc)
+                self.top[typenum].append(desc)
             # Index by id
             if desc.id in self.by_id:
                 raise BadDefinitionError('Duplicate descriptor id {}'.format(desc.id))
             self.by_id[desc.id] = desc
             # Index by type
-            if typenum not in self.by_type:
-                self.by_type[typenum] = [desc]
-            else:
-                self.by_type[typenum].append(desc)
+            self.by_type[typenum].append(desc)
             # Assign indexes
             #
             # FIXME: This assigns index by type number. It should be assigned by parent.
-            if typenum not in self.indexes:
-                self.indexes[typenum] = 0
             desc.index = self.indexes[typenum]
             self.indexes[typenum] += 1
-        for typenum, desc in builder:
-            # Handle post-parse events
+        # Handle post-parse events. by_id holds every descriptor in the order
+        # the builder produced them.
+        for desc in self.by_id.values():
             desc.post_parse(self)
 
     def find_by_id(self, idname):
-        return self.by_id[idname] if idname in self.by_id else None
+        return self.by_id.get(idname)
 
     def find_by_type(self, typenum):
-        return self.by_type[typenum] if typenum in self.by_type else []
+        return self.by_type.get(typenum, ())
 
     def reserve_endpoint(self):
         if self.__endpoint >= self.max_endpoints:
@@ -653,61 +808,33 @@ class DescriptorCollection(object):
     def device(self):
         return self.__device
 
-    def to_source_iter(self, include):
+    def emit(self, out, include):
+        """
+        Appends the lines of source for our descriptors to out
+        """
         if include:
-            yield '#include "{}"'.format(include)
-        yield '#include "usb.h"'
+            out.append('#include "{}"'.format(include))
+        out.append('#include "usb.h"')
         for i in self.includes:
-            yield i.to_source()
-        yield """
-/******************************************************************************
- * AUTOGENERATED FILE
- *
- * DO NOT MODIFY!
- *
- * Invocation:
- * {}
- *****************************************************************************/
- """.format(' '.join(sys.argv))
+            i.emit(out)
+        out.append(SOURCE_BANNER.format(invocation=' '.join(sys.argv)))
         all_desc = reversed(
                 sorted([d for tn, ds in self.top.items() for d in ds], key=lambda d: d.order))
         for d in all_desc:
-            yield 'static const USB_DATA_ALIGN uint8_t {}[] = {{'.format(d.id)
+            out.append(DESCRIPTOR_BEGIN.format(id=d.id))
             # indent the descriptor slightly
-            yield '  ' + d.to_source().replace('\n', '\n  ')
-            yield '};\n'
-        yield 'const USBDescriptorEntry usb_descriptors[] = {'
+            start = len(out)
+            d.emit(out)
+            indent_lines(out, start)
+            out.append(DESCRIPTOR_END)
+        out.append(DESCRIPTOR_TABLE_BEGIN)
         for typenum, descriptors in self.top.items():
             for d in descriptors:
-                yield '  {{ 0x{:02x}{:02x}, {:#06x}, sizeof({}), {} }},'\
-                        .format(d.type, d.index, d.wIndex, d.id, d.id)
-        yield '  { 0x0000, 0x0000, 0x00, NULL }'
-        yield '};'
+                out.append(DESCRIPTOR_TABLE_ENTRY.format(d=d))
+        out.append(DESCRIPTOR_TABLE_END)
 
     def to_header_iter(self):
-        yield """#ifndef _USB_DESCRIPTOR_AUTOGEN_H_
-#define _USB_DESCRIPTOR_AUTOGEN_H_
-
-/******************************************************************************
- * AUTOGENERATED FILE
- *
- * DO NOT MODIFY!
- *
- * Invocation:
- * {}
- *****************************************************************************/
-
-#include <stdint.h>
-#include <stddef.h>
-
-typedef struct {{
-    uint16_t wValue;
-    uint16_t wIndex;
-    size_t length;
-    const void *addr;
-}} USBDescriptorEntry;
-
-extern const USBDescriptorEntry usb_descriptors[];""".format(' '.join(sys.argv))
+        yield HEADER_PROLOGUE.format(invocation=' '.join(sys.argv))
         for typenum, descriptors in self.top.items():
             for d in descriptors:
                 yield d.to_header()
@@ -717,69 +844,123 @@ extern const USBDescriptorEntry usb_descriptors[];""".format(' '.join(sys.argv))
         """
         Creates source code for our descriptors
         """
-        return os.linesep.join(self.to_source_iter(include)) + os.linesep
+        out = []
+        self.emit(out, include)
+        return '\n'.join(out) + '\n'
 
     def to_header(self):
         """
         Creates header content for our descriptors
         """
-        return os.linesep.join(self.to_header_iter()) + os.linesep
+        return '\n'.join(self.to_header_iter()) + '\n'
 
 
 ###############################################################################
 # File parsing
 ###############################################################################
 
+# Comments must open on their own line, optionally preceded by whitespace
+C_COMMENT_RE = re.compile(rb'^[ \t]*/\*(.*?)\*/', re.DOTALL | re.MULTILINE)
+COMMENT_PREFIX_RE = re.compile(rb'(?m)^[ \t]*\**')
+
 def extract_c_comments(filename):
     """
     Extracts the contents of C comments from the passed file
+
+    The file is scanned as bytes and only the comments are decoded
     """
-    with open(filename) as f:
-        gathering = False
-        gathered = None
-        for line in f:
-            stripped = line.lstrip()
-            if not gathering and stripped.startswith('/*'):
-                gathering = True
-            elif gathering and stripped.rstrip().endswith('*/'):
-                gathering = False
-                yield gathered
-                gathered = None
-            elif gathering:
-                no_stars = stripped.lstrip('*')
-                gathered = gathered + no_stars if gathered else no_stars
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for m in C_COMMENT_RE.finditer(data):
+        yield COMMENT_PREFIX_RE.sub(b'', m.group(1)).decode('utf-8')
+
+# Closed parsers which are ready for another fragment
+idle_parsers = []
 
-def extract_elements(fragment, fname=None):
+def acquire_parser():
     """
-    Extracts possible descriptor elements from the passed fragment
+    Returns a pull parser which is ready for a new document
+    """
+    if idle_parsers:
+        return idle_parsers.pop()
+    return ET.XMLPullParser(events=('start', 'end'), **PARSER_OPTIONS)
 
-    Returns an interable
+def release_parser(parser):
+    """
+    Returns a cleanly closed parser so that it can be used again
     """
-    if not re.search('<descriptor.+>', fragment, re.MULTILINE):
-        fragment = ''
+    if REUSABLE_PARSER:
+        idle_parsers.append(parser)
 
+def has_descriptors(fragment):
+    """
+    Returns whether or not the passed comment fragment declares descriptors
+    """
+    return '<descriptor' in fragment
+
+def extract_elements(fragments, fname=None):
+    """
+    Extracts descriptor elements from the passed comment fragments, which are
+    parsed together as a single document
+
+    Returns an iterable of the top-level elements. Each fragment is fed to
+    the parser in turn and elements are yielded as soon as they are complete.
+    An element is cleared and removed from the document once the next one is
+    requested, so it must be fully consumed before continuing.
+    """
+    parser = acquire_parser()
+    fed = []
+    depth = 0
+    root = None
+    def completed():
+        nonlocal depth, root
+        for event, el in parser.read_events():
+            if event == 'start':
+                if depth == 0:
+                    root = el
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield el
+                # Only the element currently being handled is kept in memory
+                el.clear()
+                root.remove(el)
     try:
-        return ET.fromstring('<root>' + fragment + '</root>')
-    except ET.ParseError as e:
-        source_lines = fragment.splitlines()
+        parser.feed('<root>')
+        for fragment in fragments:
+            fed.append(fragment)
+            parser.feed(fragment)
+            yield from completed()
+        parser.feed('</root>')
+        yield from completed()
+        parser.close()
+    except ParseError as e:
+        source_lines = ''.join(fed).splitlines()
         max_lines = str(len(source_lines))
         numbers = [str(i).ljust(len(max_lines)) + ' |' for i in range(1, len(source_lines)+1)]
         numbered_lines = list([''.join(t) for t in zip(numbers, source_lines)])
         min_line = max(1, e.position[0]-3) - 1
         max_line = min(len(source_lines)+1, e.position[0]+3) - 1
-        fname = fname + os.linesep if fname else ''
-        e.xml_source = fname + os.linesep.join(numbered_lines[min_line:max_line])
+        fname = fname + '\n' if fname else ''
+        e.xml_source = fname + '\n'.join(numbered_lines[min_line:max_line])
         raise
+    release_parser(parser)
 
 def write_if_different(content, filename):
-    if os.path.exists(filename):
-        with open(filename) as f:
-            old_content = f.read()
-    else:
-        old_content = ''
-    if old_content != content:
-        with open(filename, 'w') as f:
-            f.write(content)
+    # Written as bytes so the generated C always uses LF line endings,
+    # whatever the host
+    data = content.encode('utf-8')
+    try:
+        # A file of a different size can't match, so it isn't read
+        if os.path.getsize(filename) == len(data):
+            with open(filename, 'rb') as f:
+                if f.read() == data:
+                    return
+    except FileNotFoundError:
+        pass
+    with open(filename, 'wb') as f:
+        f.write(data)
 
 def main():
     parser = argparse.ArgumentParser(description='Parses USB descriptors into a C file',
@@ -794,8 +975,9 @@ def main():
 
     builder = DescriptorCollectionBuilder()
     for f in args.files:
-        elements = [el for c in extract_c_comments(f) for el in extract_elements(c, f)]
-        for el in elements:
+        # All descriptor comments in a file are parsed as one document
+        fragments = (c for c in extract_c_comments(f) if has_descriptors(c))
+        for el in extract_elements(fragments, f):
             builder.add_descriptors(el)
     descriptors = builder.compile()
 
@@ -805,7 +987,7 @@ def main():
 if __name__ == '__main__':
     try:
         main()
-    except ET.ParseError as e:
+    except ParseError as e:
         if hasattr(e, 'xml_source'):
             print(e.xml_source)
         raise
@@ -8,6 +8,13 @@ import struct
 VID = 0x16c0
 PID = 0x05dc
 
+# Commands and responses share the same 64 byte report layout
+COMMAND_STRUCT = struct.Struct('<I60s')
+RESPONSE_STRUCT = COMMAND_STRUCT
+PARAMETERS_STRUCT = struct.Struct('<15i')
+# Data of the parameter get and set commands
+PARAMETER_COMMAND_STRUCT = struct.Struct('<IIII')
+
 class Command(object):
     """
     Basic command structure: 4 bytes of command followed by up to 60 bytes of data
@@ -15,9 +22,14 @@ class Command(object):
     def __init__(self, command, data_bytes):
         self.command = command
         self.data_bytes = data_bytes
+        # Commands don't change once created, so they are only packed once
+        self.packed = COMMAND_STRUCT.pack(command, data_bytes)
 
     def pack(self):
-        return struct.pack('<I60s', self.command, self.data_bytes)
+        return self.packed
+
+    def pack_into(self, buf, offset):
+        buf[offset:offset+len(self.packed)] = self.packed
 
 class StatusCommand(Command):
     """
@@ -31,14 +43,14 @@ class GetCommand(Command):
     Command to get a parameter
     """
     def __init__(self, parameter):
-        super().__init__(0x40, struct.pack('<IIII', 0, parameter, 0, 0))
+        super().__init__(0x40, PARAMETER_COMMAND_STRUCT.pack(0, parameter, 0, 0))
 
 class SetCommand(Command):
     """
     Command to set a parameter
     """
     def __init__(self, parameter, value, size):
-        super().__init__(0x80, struct.pack('<IIII', 0, parameter, value, size))
+        super().__init__(0x80, PARAMETER_COMMAND_STRUCT.pack(0, parameter, value, size))
 
 class EnterBootloaderCommand(Command):
     """
@@ -52,10 +64,10 @@ class Response(object):
     Basic response structure: 4 bytes of command followed by up to 60 bytes of data
     """
     def __init__(self, data_bytes):
-        unpacked = struct.unpack('<I60s', bytes(data_bytes))
+        unpacked = RESPONSE_STRUCT.unpack(bytes(data_bytes))
         self.command = unpacked[0]
         self.bytes = unpacked[1]
-        self.parameters = struct.unpack('<15i', self.bytes)
+        self.parameters = PARAMETERS_STRUCT.unpack(self.bytes)
 
     @property
     def status(self):
@@ -81,6 +93,9 @@ class Device(hid.device):
     PRODUCT='Midi-Fader'
     def __init__(self, path):
         self.path = path
+        # Every report is written through this buffer. The first byte stays
+        # zero since we don't use REPORT_ID
+        self.write_buffer = bytearray(1 + COMMAND_STRUCT.size)
 
     def __enter__(self):
         self.open_path(self.path)
@@ -102,8 +117,8 @@ class Device(hid.device):
         return Response(self.write_command(cmd))
 
     def write_command(self, command, response=True):
-        data = b'\x00' + command.pack() #prepend a zero since we don't use REPORT_ID
-        result = self.write(data)
+        command.pack_into(self.write_buffer, 1)
+        result = self.write(self.write_buffer)
         if result < 0:
             raise ValueError(self.error())
         if not response:
@@ -6,14 +6,19 @@ Places information about firmware into the passed file
 import argparse, subprocess, textwrap, os
 
 def write_if_different(content, filename):
-    if os.path.exists(filename):
-        with open(filename) as f:
-            old_content = f.read()
-    else:
-        old_content = ''
-    if old_content != content:
-        with open(filename, 'w') as f:
-            f.write(content)
+    # Written as bytes so the generated C always uses LF line endings,
+    # whatever the host
+    data = content.encode('utf-8')
+    try:
+        # A file of a different size can't match, so it isn't read
+        if os.path.getsize(filename) == len(data):
+            with open(filename, 'rb') as f:
+                if f.read() == data:
+                    return
+    except FileNotFoundError:
+        pass
+    with open(filename, 'wb') as f:
+        f.write(data)
 def main():
     parser = argparse.ArgumentParser(description='Places repository information into the passed C file',
             formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -21,8 +26,9 @@ def main():
     parser.add_argument('file', help='File to update, if needed')
     args = parser.parse_args()
 
-    version = subprocess.check_output(['git', 'describe', '--dirty']).strip()
-    contents = 'const char *firmware_version = "{}";\n'.format(version.decode('utf8'));
+    version = subprocess.run(['git', 'describe', '--dirty'], stdout=subprocess.PIPE,
+            check=True, universal_newlines=True).stdout.strip()
+    contents = 'const char *firmware_version = "{}";\n'.format(version);
     write_if_different(contents, args.file)
 
 if __name__ == '__main__':
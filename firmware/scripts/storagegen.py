@@ -4,56 +4,30 @@ Compiles XML files into a C source file whose symbols live in the storage
 section
 """
 
-import argparse, inspect, os, textwrap, sys
-from collections import namedtuple
+import argparse, os, textwrap, sys
 import xml.etree.ElementTree as ET
 
-FormatType = namedtuple('FormatType', ['type'])
+# Maps each type string to the ValueFormatter class which formats it
+_FORMATTERS = {}
 
 def formats(typestr):
     """
     Declares that this class can format the passed type string
     """
     def decorator(cls):
-        if not inspect.isclass(cls):
+        if not isinstance(cls, type):
             raise ValueError("The @formats decorator is only valid for classes")
-        attrname_format = '__formats{}'
-        index = 0
-        while hasattr(cls, attrname_format.format(index)):
-            index += 1
-        setattr(cls, attrname_format.format(index), FormatType(typestr))
+        _FORMATTERS[typestr] = cls
         return cls
     return decorator
 
 class ValueFormatter(object):
-    @classmethod
-    def subclasses(cls):
-        all_cls = []
-        for c in cls.__subclasses__():
-            all_cls.append(c)
-            all_cls.extend(c.subclasses())
-        return all_cls
-
-    @classmethod
-    def match_typestr(cls, typestr):
-        """
-        Returns whether or not this formatter can handle the passed typestr
-        """
-        for attr_name in dir(cls):
-            attr = getattr(cls, attr_name)
-            if isinstance(attr, FormatType) and attr.type == typestr:
-                return True
-        return False
-
     @classmethod
     def get_formatter(cls, el):
-        handled = False
-        for c in cls.subclasses():
-            if c.match_typestr(el.attrib['type']):
-                handled = True
-                return c(el)
-        if not handled:
+        c = _FORMATTERS.get(el.attrib['type'])
+        if c is None:
             raise ValueError('No value formatter declared for type {}'.format(el.attrib['type']))
+        return c(el)
 
     def __init__(self, size):
         self.size = size
@@ -68,12 +42,11 @@ class NumericFormatter(ValueFormatter):
     def __init__(self, size, value):
         self.value = value
         super().__init__(size)
+        # The byte shifts only depend on the size, so the template is built once
+        self.template = ', '.join(['(((uint32_t)({{0}}) >> {}) & 0xFF)'.format(i*8) for i in range(0, self.size)])
 
     def to_source(self):
-        parts = list(['(((uint32_t)({}) >> {}) & 0xFF)'.format(self.value, i*8) for i in range(0, self.size)])
-        if len(parts):
-            return ', '.join(parts)
-        return ''
+        return self.template.format(self.value)
 
 @formats('uint8')
 class ByteFormatter(NumericFormatter):
@@ -146,7 +119,7 @@ class ValueCollection(object):
             self.parameters.add(value.parameter)
 
     def to_header(self):
-        headers = os.linesep.join([v.to_header() for v in self.values])
+        headers = '\n'.join([v.to_header() for v in self.values])
         return """#ifndef _STORAGE_AUTOGEN_H_
 #define _STORAGE_AUTOGEN_H_
 
@@ -167,8 +140,8 @@ class ValueCollection(object):
  """.format(' '.join(sys.argv), headers)
 
     def to_source(self, section):
-        includes = os.linesep.join(['#include "{}"'.format(i) for i in self.includes])
-        definitions = os.linesep.join([v.to_source() for v in self.values])
+        includes = '\n'.join(['#include "{}"'.format(i) for i in self.includes])
+        definitions = '\n'.join([v.to_source() for v in self.values])
         return """
 /******************************************************************************
  * AUTOGENERATED FILE
@@ -194,14 +167,19 @@ static uint16_t _STORAGE_MAGIC storageMagic = 0xABCD;
 {3}""".format(' '.join(sys.argv), includes, section, definitions)
 
 def write_if_different(content, filename):
-    if os.path.exists(filename):
-        with open(filename) as f:
-            old_content = f.read()
-    else:
-        old_content = ''
-    if old_content != content:
-        with open(filename, 'w') as f:
-            f.write(content)
+    # Written as bytes so the generated C always uses LF line endings,
+    # whatever the host
+    data = content.encode('utf-8')
+    try:
+        # A file of a different size can't match, so it isn't read
+        if os.path.getsize(filename) == len(data):
+            with open(filename, 'rb') as f:
+                if f.read() == data:
+                    return
+    except FileNotFoundError:
+        pass
+    with open(filename, 'wb') as f:
+        f.write(data)
 def main():
     parser = argparse.ArgumentParser(description='Parses storage defaults into a C file',
             formatter_class=argparse.RawDescriptionHelpFormatter,